@@ -2,7 +2,7 @@ import gzip
 import json
 import random
 
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 
 
 class MeliChallengeDataset(IterableDataset):
@@ -22,11 +22,17 @@ class MeliChallengeDataset(IterableDataset):
         return self.dataset_size
 
     def __iter__(self):
+        worker_info = get_worker_info()
         try:
             with gzip.open(self.dataset_path, "rt") as dataset:
                 shuffle_buffer = []
 
-                for line in dataset:
+                for lineno, line in enumerate(dataset):
+                    if worker_info is not None and \
+                            lineno % worker_info.num_workers != worker_info.id:
+                        # Stride the lines across DataLoader workers so each
+                        # item is yielded by exactly one of them
+                        continue
                     item = json.loads(line.strip())
                     item = {
                         "data": item["data"],
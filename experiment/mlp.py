@@ -1,8 +1,17 @@
 import argparse
 import gzip
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
+import os
+import tempfile
+
+from itertools import islice
+
 import mlflow
+import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -13,7 +22,7 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm, trange
 
 from .dataset import MeliChallengeDataset
-from .utils import PadSequences
+from .utils import CUDAPrefetcher, PadSequences
 
 
 logging.basicConfig(
@@ -22,6 +31,72 @@ logging.basicConfig(
 )
 
 
+# Worker-side state for the embeddings parser pool, set once per worker by
+# the initializer instead of pickling the vocabulary with every chunk
+_parser_token_to_index = None
+_parser_vector_size = None
+
+
+def _init_embeddings_parser(token_to_index, vector_size):
+    global _parser_token_to_index, _parser_vector_size
+    _parser_token_to_index = token_to_index
+    _parser_vector_size = vector_size
+
+
+def _parse_embeddings_chunk(lines):
+    rows_idx = []
+    rows_vec = []
+    for line in lines:
+        word, vector = line.strip().split(None, 1)
+        if word in _parser_token_to_index:
+            rows_idx.append(_parser_token_to_index[word])
+            # C-level parse of the whole row instead of a Python
+            # float() loop
+            rows_vec.append(np.fromstring(vector, dtype=np.float32,
+                                          sep=" ", count=_parser_vector_size))
+    if not rows_vec:
+        return (np.empty(0, dtype=np.int64),
+                np.empty((0, _parser_vector_size), dtype=np.float32))
+    return np.asarray(rows_idx, dtype=np.int64), np.stack(rows_vec)
+
+
+def _iter_line_chunks(fh, chunk_size=100000):
+    chunk = list(islice(fh, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(fh, chunk_size))
+
+
+def build_embeddings_matrix(pretrained_embeddings_path, token_to_index,
+                            vector_size):
+    embeddings_matrix = torch.empty(len(token_to_index), vector_size)
+    rows_idx = []
+    rows_vec = []
+    # A gzip stream cannot be sharded by byte offset, so the main process
+    # keeps the sequential decompression and ships chunks of decoded lines
+    # to a worker pool that does the expensive split + float parsing
+    with gzip.open(pretrained_embeddings_path, "rt") as fh:
+        next(fh)
+        with multiprocessing.Pool(initializer=_init_embeddings_parser,
+                                  initargs=(token_to_index, vector_size)) as pool:
+            for idx, vec in pool.imap_unordered(_parse_embeddings_chunk,
+                                                _iter_line_chunks(fh)):
+                if idx.size > 0:
+                    rows_idx.append(idx)
+                    rows_vec.append(vec)
+    found = torch.zeros(len(token_to_index), dtype=torch.bool)
+    if rows_idx:
+        rows_idx = torch.from_numpy(np.concatenate(rows_idx))
+        embeddings_matrix[rows_idx] = torch.from_numpy(np.concatenate(rows_vec))
+        found[rows_idx] = True
+    # Only the rows missing from the pretrained file need a random init
+    missing = (~found).nonzero(as_tuple=True)[0]
+    if missing.numel() > 0:
+        embeddings_matrix[missing] = torch.randn(missing.size(0), vector_size)
+    embeddings_matrix[0] = torch.zeros(vector_size)
+    return embeddings_matrix
+
+
 class MLPClassifier(nn.Module):
     def __init__(self,
                  pretrained_embeddings_path,
@@ -30,41 +105,94 @@ class MLPClassifier(nn.Module):
                  hidden_layers=[256, 128],
                  dropout=0.3,
                  vector_size=300,
-                 freeze_embedings=True):
+                 freeze_embedings=True,
+                 quantize_embedings=False):
         super().__init__()
+        # The parse of the gzipped text embeddings is expensive: cache the
+        # resulting matrix keyed by the input paths and vector size so
+        # every run after the first loads it in milliseconds
+        cache_key = hashlib.sha1(
+            f"{pretrained_embeddings_path}:{token_to_index}:{vector_size}".encode()
+        ).hexdigest()
+        # Per-user directory rather than a predictable world-writable /tmp
+        # path, so other users on a shared cluster cannot plant a cache file
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "diplodatos")
+        cache_path = os.path.join(cache_dir, f"emb_{cache_key}.pt")
         with gzip.open(token_to_index, "rt") as fh:
             token_to_index = json.load(fh)
-        embeddings_matrix = torch.randn(len(token_to_index), vector_size)
-        embeddings_matrix[0] = torch.zeros(vector_size)
-        with gzip.open(pretrained_embeddings_path, "rt") as fh:
-            next(fh)
-            for line in fh:
-                word, vector = line.strip().split(None, 1)
-                if word in token_to_index:
-                    embeddings_matrix[token_to_index[word]] =\
-                        torch.FloatTensor([float(n) for n in vector.split()])
-        self.embeddings = nn.Embedding.from_pretrained(embeddings_matrix,
-                                                       freeze=freeze_embedings,
-                                                       padding_idx=0)
-        self.hidden_layers = [
-            nn.Linear(vector_size, hidden_layers[0])
-        ]
-        for input_size, output_size in zip(hidden_layers[:-1], hidden_layers[1:]):
-            self.hidden_layers.append(
-                nn.Linear(input_size, output_size)
+        embeddings_matrix = None
+        if os.path.exists(cache_path):
+            logging.info(f"Loading cached embeddings matrix from {cache_path}")
+            try:
+                embeddings_matrix = torch.load(cache_path, map_location="cpu",
+                                               weights_only=True)
+            except Exception:
+                # A run killed mid-save leaves a truncated file behind;
+                # re-parse instead of aborting
+                logging.warning(f"Discarding unreadable cache {cache_path}")
+                embeddings_matrix = None
+        if embeddings_matrix is None:
+            embeddings_matrix = build_embeddings_matrix(
+                pretrained_embeddings_path, token_to_index, vector_size)
+            os.makedirs(cache_dir, exist_ok=True)
+            # Save to a temp file and move it into place so an interrupted
+            # run never leaves a partial file at the final path
+            with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".pt",
+                                             delete=False) as cache_fh:
+                torch.save(embeddings_matrix, cache_fh)
+            os.replace(cache_fh.name, cache_path)
+        if freeze_embedings and quantize_embedings:
+            # One step below fp16: int8 rows with per-row fp16 scales cut
+            # the gather bandwidth 4x versus fp32; dequantization after the
+            # lookup is a cheap pointwise op
+            scale = embeddings_matrix.abs().amax(dim=1, keepdim=True)\
+                .clamp(min=1e-8) / 127
+            self.register_buffer(
+                "embeddings_q",
+                (embeddings_matrix / scale).round().clamp(-128, 127).to(torch.int8)
             )
-        self.dropout = dropout
-        self.hidden_layers = nn.ModuleList(self.hidden_layers)
+            self.register_buffer("embeddings_scale", scale.half())
+            self.embeddings = None
+        else:
+            if freeze_embedings:
+                # The table is read-only, so keep it in fp16: halves the bytes
+                # gathered per batch and autocast would cast downstream anyway
+                embeddings_matrix = embeddings_matrix.half()
+            self.embeddings = nn.EmbeddingBag.from_pretrained(embeddings_matrix,
+                                                              freeze=freeze_embedings,
+                                                              padding_idx=0,
+                                                              mode="mean")
+        layers = []
+        for input_size, output_size in zip([vector_size] + hidden_layers[:-1],
+                                           hidden_layers):
+            layers.append(nn.Linear(input_size, output_size))
+            layers.append(nn.ReLU(inplace=True))
+            if dropout:
+                layers.append(nn.Dropout(dropout))
+        self.hidden_layers = nn.Sequential(*layers)
         self.output = nn.Linear(hidden_layers[-1], n_labels)
         self.vector_size = vector_size
 
-    def forward(self, x):
-        x = self.embeddings(x)
-        x = torch.mean(x, dim=1)
-        for layer in self.hidden_layers:
-            x = F.relu(layer(x))
-            if self.dropout:
-                x = F.dropout(x, self.dropout)
+    def forward(self, x, lengths=None):
+        if self.embeddings is None:
+            # Quantized path: gather int8 rows and their scales, dequantize
+            # in fp16, then mean-pool over the real (non-pad) tokens using
+            # the precomputed lengths from the collate function
+            gathered = F.embedding(x, self.embeddings_q).to(torch.float16)
+            gathered = gathered * F.embedding(x, self.embeddings_scale)
+            if lengths is None:
+                lengths = (x != 0).sum(dim=1)
+            lengths = lengths.clamp(min=1)
+            x = gathered.sum(dim=1) / lengths.unsqueeze(1).to(gathered.dtype)
+        else:
+            # EmbeddingBag fuses the row gather and the mean pooling into one
+            # kernel, never materializing the (batch, length, vector_size)
+            # intermediate; rows at padding_idx are left out of the mean
+            x = self.embeddings(x)
+        if x.dtype != torch.float32 and not torch.is_autocast_enabled():
+            # Outside an autocast region the fp32 Linears need fp32 input
+            x = x.float()
+        x = self.hidden_layers(x)
         x = self.output(x)
         return x
 
@@ -104,9 +232,21 @@ if __name__ == "__main__":
                         help="Number of epochs",
                         default=3,
                         type=int)
+    parser.add_argument("--batch-size",
+                        help="Size of the batches. With mixed precision the "
+                             "activations are small enough to go well past 128.",
+                        default=1024,
+                        type=int)
+    parser.add_argument("--lr",
+                        help="Learning rate. Defaults to 1e-3 scaled by the "
+                             "square-root rule relative to batch size 128.",
+                        type=float)
 
     args = parser.parse_args()
 
+    if args.lr is None:
+        args.lr = 1e-3 * math.sqrt(args.batch_size / 128)
+
     pad_sequences = PadSequences(
         pad_value=0,
         max_length=None,
@@ -120,10 +260,14 @@ if __name__ == "__main__":
     )
     train_loader = DataLoader(
         train_dataset,
-        batch_size=128,  # This can be a hyperparameter
+        batch_size=args.batch_size,
         shuffle=False,
         collate_fn=pad_sequences,
-        drop_last=False
+        drop_last=False,
+        num_workers=4,  # This can be a hyperparameter
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=True,
+        prefetch_factor=4
     )
 
     if args.validation_data:
@@ -134,10 +278,14 @@ if __name__ == "__main__":
         )
         validation_loader = DataLoader(
             validation_dataset,
-            batch_size=128,
+            batch_size=args.batch_size,
             shuffle=False,
             collate_fn=pad_sequences,
-            drop_last=False
+            drop_last=False,
+            num_workers=4,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=True,
+            prefetch_factor=4
         )
     else:
         validation_dataset = None
@@ -151,10 +299,14 @@ if __name__ == "__main__":
         )
         test_loader = DataLoader(
             test_dataset,
-            batch_size=128,
+            batch_size=args.batch_size,
             shuffle=False,
             collate_fn=pad_sequences,
-            drop_last=False
+            drop_last=False,
+            num_workers=4,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=True,
+            prefetch_factor=4
         )
     else:
         test_dataset = None
@@ -171,10 +323,28 @@ if __name__ == "__main__":
             "hidden_layers": args.hidden_layers,
             "dropout": args.dropout,
             "embeddings_size": args.embeddings_size,
-            "epochs": args.epochs
+            "epochs": args.epochs,
+            "batch_size": args.batch_size,
+            "lr": args.lr
         })
         device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
+        # TF32 matmuls on Ampere+ for everything that stays in fp32, and
+        # let cudnn autotune its algorithm choices
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        torch.backends.cudnn.benchmark = True
+
+        if device.type == "cuda":
+            # Copy batch N+1 on a side stream while batch N runs; the
+            # .to(device) calls in the loops become no-ops
+            train_loader = CUDAPrefetcher(train_loader, device)
+            if validation_loader is not None:
+                validation_loader = CUDAPrefetcher(validation_loader, device)
+            if test_loader is not None:
+                test_loader = CUDAPrefetcher(test_loader, device)
+
         logging.info("Building classifier")
         model = MLPClassifier(
             pretrained_embeddings_path=args.pretrained_embeddings,
@@ -183,65 +353,97 @@ if __name__ == "__main__":
             hidden_layers=args.hidden_layers,
             dropout=args.dropout,
             vector_size=args.embeddings_size,
-            freeze_embedings=True  # This can be a hyperparameter
+            freeze_embedings=True,  # This can be a hyperparameter
+            quantize_embedings=False  # This can be a hyperparameter
         )
         model = model.to(device)
+        if hasattr(torch, "compile"):
+            # Fuse the tiny per-op kernels of the MLP and capture CUDA
+            # graphs to cut per-step launch overhead
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
         loss = nn.CrossEntropyLoss()
         optimizer = optim.Adam(
             model.parameters(),
-            lr=1e-3,  # This can be a hyperparameter
-            weight_decay=1e-5  # This can be a hyperparameter
+            lr=args.lr,
+            weight_decay=1e-5,  # This can be a hyperparameter
+            fused=torch.cuda.is_available()  # One multi-tensor update kernel
         )
+        # Mixed precision: fp16 forward/backward on GPU, fp32 master weights
+        scaler = torch.cuda.amp.GradScaler(enabled=device.type == "cuda")
 
         logging.info("Training classifier")
         for epoch in trange(args.epochs):
             model.train()
-            running_loss = []
+            # Accumulate the loss on-device: a .item() per step would force
+            # a GPU sync and stop the CPU from running ahead
+            loss_sum = torch.zeros((), device=device)
+            n_batches = 0
             for idx, batch in enumerate(tqdm(train_loader)):
-                optimizer.zero_grad()
-                data = batch["data"].to(device)
-                target = batch["target"].to(device)
-                output = model(data)
-                loss_value = loss(output, target)
-                loss_value.backward()
-                optimizer.step()
-                running_loss.append(loss_value.item())
-            mlflow.log_metric("train_loss", sum(running_loss) / len(running_loss), epoch)
+                optimizer.zero_grad(set_to_none=True)
+                data = batch["data"].to(device, non_blocking=True)
+                lengths = batch["lengths"].to(device, non_blocking=True)
+                target = batch["target"].to(device, non_blocking=True)
+                with torch.cuda.amp.autocast(enabled=device.type == "cuda",
+                                             dtype=torch.float16):
+                    output = model(data, lengths)
+                    loss_value = loss(output, target)
+                scaler.scale(loss_value).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                loss_sum += loss_value.detach()
+                n_batches += 1
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            mlflow.log_metric("train_loss", (loss_sum / n_batches).item(), epoch)
 
             if validation_dataset:
                 logging.info("Evaluating model on validation")
                 model.eval()
-                running_loss = []
+                loss_sum = torch.zeros((), device=device)
+                n_batches = 0
                 targets = []
                 predictions = []
                 with torch.no_grad():
                     for batch in tqdm(validation_loader):
-                        data = batch["data"].to(device)
-                        target = batch["target"].to(device)
-                        output = model(data)
-                        running_loss.append(
-                            loss(output, target).item()
-                        )
-                        targets.extend(batch["target"].numpy())
-                        predictions.extend(output.argmax(axis=1).detach().cpu().numpy())
-                    mlflow.log_metric("validation_loss", sum(running_loss) / len(running_loss), epoch)
+                        data = batch["data"].to(device, non_blocking=True)
+                        lengths = batch["lengths"].to(device, non_blocking=True)
+                        target = batch["target"].to(device, non_blocking=True)
+                        with torch.cuda.amp.autocast(enabled=device.type == "cuda",
+                                                     dtype=torch.float16):
+                            output = model(data, lengths)
+                            loss_value = loss(output, target)
+                        loss_sum += loss_value
+                        n_batches += 1
+                        # Stay on-device; one D2H transfer after the loop
+                        targets.append(target)
+                        predictions.append(output.argmax(dim=1))
+                    targets = torch.cat(targets).cpu().numpy()
+                    predictions = torch.cat(predictions).cpu().numpy()
+                    mlflow.log_metric("validation_loss", (loss_sum / n_batches).item(), epoch)
                     mlflow.log_metric("validation_bacc", balanced_accuracy_score(targets, predictions), epoch)
 
         if test_dataset:
             logging.info("Evaluating model on test")
             model.eval()
-            running_loss = []
+            loss_sum = torch.zeros((), device=device)
+            n_batches = 0
             targets = []
             predictions = []
             with torch.no_grad():
                 for batch in tqdm(test_loader):
-                    data = batch["data"].to(device)
-                    target = batch["target"].to(device)
-                    output = model(data)
-                    running_loss.append(
-                        loss(output, target).item()
-                    )
-                    targets.extend(batch["target"].numpy())
-                    predictions.extend(output.argmax(axis=1).detach().cpu().numpy())
-                mlflow.log_metric("test_loss", sum(running_loss) / len(running_loss), epoch)
+                    data = batch["data"].to(device, non_blocking=True)
+                    lengths = batch["lengths"].to(device, non_blocking=True)
+                    target = batch["target"].to(device, non_blocking=True)
+                    with torch.cuda.amp.autocast(enabled=device.type == "cuda",
+                                                 dtype=torch.float16):
+                        output = model(data, lengths)
+                        loss_value = loss(output, target)
+                    loss_sum += loss_value
+                    n_batches += 1
+                    # Stay on-device; one D2H transfer after the loop
+                    targets.append(target)
+                    predictions.append(output.argmax(dim=1))
+                targets = torch.cat(targets).cpu().numpy()
+                predictions = torch.cat(predictions).cpu().numpy()
+                mlflow.log_metric("test_loss", (loss_sum / n_batches).item(), epoch)
                 mlflow.log_metric("test_bacc", balanced_accuracy_score(targets, predictions), epoch)
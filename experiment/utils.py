@@ -8,6 +8,46 @@ from gensim.parsing import preprocessing
 from tqdm import tqdm
 
 
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader so the next batch is copied to the GPU on a
+    dedicated CUDA stream while the current batch is being consumed,
+    hiding the PCIe transfer behind compute.
+    """
+
+    def __init__(self, loader, device):
+        assert device.type == "cuda"
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            return {key: value.to(self.device, non_blocking=True)
+                    for key, value in batch.items()}
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            batch = next_batch
+            for value in batch.values():
+                # The copy happened on the side stream; tell the caching
+                # allocator the default stream now owns these tensors
+                value.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(iterator, stream)
+            yield batch
+
+
 class PadSequences:
     def __init__(self, pad_value=0, max_length=None, min_length=1):
         assert max_length is None or min_length <= max_length
@@ -25,11 +65,24 @@ class PadSequences:
             seq_lengths = [min(self.max_length, l) for l in seq_lengths]
         else:
             max_length = max(self.min_length, max(seq_lengths))
+            # Round up to a multiple of 32 so only a handful of distinct
+            # shapes reach the model: keeps CUDA graph capture stable under
+            # torch.compile instead of recompiling on every batch. The extra
+            # pad tokens never enter the mean pooling.
+            max_length = ((max_length + 31) // 32) * 32
 
-        data = [d[:l] + [self.pad_value] * (max_length - l)
-                for d, l in zip(data, seq_lengths)]
+        # Fill a preallocated tensor. Pinning is deliberately left to the
+        # DataLoader's pin_memory thread: allocating pinned memory here
+        # would initialize CUDA inside forked worker processes, which
+        # crashes, and the pinned property would not survive the IPC back
+        # to the main process anyway
+        padded = torch.full((len(data), max_length), self.pad_value,
+                            dtype=torch.long)
+        for row, (d, l) in enumerate(zip(data, seq_lengths)):
+            padded[row, :l] = torch.tensor(d[:l], dtype=torch.long)
 
         return {
-            "data": torch.LongTensor(data),
-            "target": torch.LongTensor(target)
-        }
\ No newline at end of file
+            "data": padded,
+            "lengths": torch.tensor(seq_lengths, dtype=torch.long),
+            "target": torch.tensor(target, dtype=torch.long)
+        }